@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 """This module provides the SlurmInstallManager."""
+import hashlib
 import logging
 import os
+import shutil
 import subprocess
 from base64 import b64decode, b64encode
 from pathlib import Path
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import (
+    ChoiceLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    ModuleLoader,
+)
 from slurm_ops_manager.utils import get_hostname
 
 
@@ -16,6 +24,50 @@ OS_RELEASE_CTXT = {
     for k, v in [item.split("=") for item in OS_RELEASE if item != '']
 }
 
+TEMPLATE_DIR = Path(os.path.dirname(os.path.abspath(__file__))) / 'templates'
+TEMPLATE_CACHE_DIR = Path("/var/cache/slurm-charm-jinja")
+COMPILED_TEMPLATE_ROOT = Path("/var/cache/slurm-charm-compiled")
+
+
+def _templates_checksum() -> str:
+    """Return a checksum over the names and contents of the templates."""
+    checksum = hashlib.sha1()
+    for template in sorted(TEMPLATE_DIR.glob('*.tmpl')):
+        checksum.update(template.name.encode())
+        checksum.update(template.read_bytes())
+    return checksum.hexdigest()
+
+
+# Compiled modules live in a directory keyed on the template sources, so
+# modules compiled from an older version of the templates are never used.
+COMPILED_TEMPLATE_DIR = COMPILED_TEMPLATE_ROOT / _templates_checksum()
+
+# Environment used to precompile the templates into python modules.
+_JINJA_SOURCE_ENV = Environment(
+    loader=FileSystemLoader(str(TEMPLATE_DIR)),
+    auto_reload=False,
+)
+
+# The templates ship with the package and never change at runtime, so a
+# single environment lets jinja2 reuse its compiled template cache.
+# Templates are imported from the precompiled modules when they have been
+# compiled for the current sources, otherwise they are loaded from source
+# with the bytecode cache persisting the compiled templates across hook
+# invocations. The bytecode cache is only attached when its directory exists
+# (it is created on install/upgrade), since writing to a missing directory
+# would make rendering fail.
+_JINJA_ENV = Environment(
+    loader=ChoiceLoader([
+        ModuleLoader(str(COMPILED_TEMPLATE_DIR)),
+        _JINJA_SOURCE_ENV.loader,
+    ]),
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache(
+        directory=str(TEMPLATE_CACHE_DIR),
+        pattern='%s.cache',
+    ) if TEMPLATE_CACHE_DIR.is_dir() else None,
+)
+
 logger = logging.getLogger()
 
 
@@ -24,8 +76,7 @@ class SlurmOpsManagerBase:
 
     def __init__(self, component, resource_path):
         """Set the initial values for attributes in the base class."""
-        self._template_dir = Path(
-            os.path.dirname(os.path.abspath(__file__))) / 'templates'
+        self._template_dir = TEMPLATE_DIR
 
         self._resource_path = resource_path
 
@@ -78,6 +129,24 @@ class SlurmOpsManagerBase:
         self._slurmctld_pid_file = self._slurm_pid_dir / 'slurmctld.pid'
         self._slurmdbd_pid_file = self._slurm_pid_dir / 'slurmdbd.pid'
 
+        # The paths in the common config are fixed per manager, so build
+        # it once rather than on every render.
+        self._common_config = {
+            'munge_socket': str(self._munge_socket),
+            'mail_prog': str(self._mail_prog),
+            'slurm_state_dir': str(self._slurm_state_dir),
+            'slurm_spool_dir': str(self._slurm_spool_dir),
+            'slurm_plugin_dir': str(self._slurm_plugin_dir),
+            'slurmdbd_log_file': str(self._slurmdbd_log_file),
+            'slurmd_log_file': str(self._slurmd_log_file),
+            'slurmctld_log_file': str(self._slurmctld_log_file),
+            'slurmdbd_pid_file': str(self._slurmdbd_pid_file),
+            'slurmd_pid_file': str(self._slurmd_pid_file),
+            'slurmctld_pid_file': str(self._slurmctld_pid_file),
+            'slurm_plugstack_conf': str(self._slurm_plugstack_conf),
+            'slurm_user': str(self._slurm_user),
+        }
+
         self._hostname = get_hostname()
         self._port = port_map[self._slurm_component]
 
@@ -112,7 +181,6 @@ class SlurmOpsManagerBase:
     def _slurm_systemctl(self, operation):
         """Start systemd services for slurmd."""
         supported_systemctl_cmds = [
-            "enable",
             "start",
             "stop",
             "restart",
@@ -123,14 +191,19 @@ class SlurmOpsManagerBase:
             msg = f"Unsupported systemctl command: {operation}"
             logger.error(msg)
             raise Exception(msg)
+
+        cmd = ["systemctl", operation, self._slurm_systemd_service]
+
+        # A non-zero exit from is-active only means the unit is not active.
+        if operation == "is-active":
+            return subprocess.run(cmd).returncode
+
         try:
-            subprocess.call([
-                "systemctl",
-                operation,
-                self._slurm_systemd_service,
-            ])
+            subprocess.run(cmd, check=True)
         except subprocess.CalledProcessError as e:
             logger.error(f"Error running {operation} - {e}")
+            return e.returncode
+        return 0
 
     @property
     def _slurm_conf_dir(self) -> Path:
@@ -210,22 +283,6 @@ class SlurmOpsManagerBase:
 
     def write_slurm_config(self, context) -> None:
         """Render the context to a template, adding in common configs."""
-        common_config = {
-            'munge_socket': str(self._munge_socket),
-            'mail_prog': str(self._mail_prog),
-            'slurm_state_dir': str(self._slurm_state_dir),
-            'slurm_spool_dir': str(self._slurm_spool_dir),
-            'slurm_plugin_dir': str(self._slurm_plugin_dir),
-            'slurmdbd_log_file': str(self._slurmdbd_log_file),
-            'slurmd_log_file': str(self._slurmd_log_file),
-            'slurmctld_log_file': str(self._slurmctld_log_file),
-            'slurmdbd_pid_file': str(self._slurmdbd_pid_file),
-            'slurmd_pid_file': str(self._slurmd_pid_file),
-            'slurmctld_pid_file': str(self._slurmctld_pid_file),
-            'slurm_plugstack_conf': str(self._slurm_plugstack_conf),
-            'slurm_user': str(self._slurm_user),
-        }
-
         template_name = self._slurm_conf_template_name
         source = self._slurm_conf_template_location
         target = self._slurm_conf_path
@@ -238,19 +295,34 @@ class SlurmOpsManagerBase:
                 "The slurm config template cannot be found."
             )
 
-        rendered_template = Environment(
-            loader=FileSystemLoader(str(self._template_dir))
-        ).get_template(template_name)
+        rendered_template = _JINJA_ENV.get_template(template_name)
 
         if target.exists():
             target.unlink()
 
         target.write_text(
             rendered_template.render(
-                {**context, **common_config}
+                {**context, **self._common_config}
             )
         )
 
+    def _prepare_template_cache(self) -> None:
+        """Create the template caches and precompile the config templates.
+
+        Modules compiled for previous versions of the templates are removed.
+        """
+        TEMPLATE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        COMPILED_TEMPLATE_DIR.mkdir(parents=True, exist_ok=True)
+        for compiled_dir in COMPILED_TEMPLATE_ROOT.iterdir():
+            if compiled_dir != COMPILED_TEMPLATE_DIR:
+                shutil.rmtree(str(compiled_dir), ignore_errors=True)
+        _JINJA_SOURCE_ENV.compile_templates(
+            str(COMPILED_TEMPLATE_DIR),
+            extensions=['tmpl'],
+            zip=None,
+            ignore_errors=False,
+        )
+
     def restart_slurm_component(self):
         """Restart the slurm component."""
         self._slurm_systemctl("restart")
@@ -272,11 +344,11 @@ class SlurmOpsManagerBase:
     def restart_munged(self):
         """Restart munged."""
         try:
-            return subprocess.call([
+            return subprocess.run([
                 "systemctl",
                 "restart",
                 self._munged_systemd_service,
-            ])
+            ], check=True).returncode
         except subprocess.CalledProcessError as e:
             logger.error(f"Error copying systemd - {e}")
             return -1
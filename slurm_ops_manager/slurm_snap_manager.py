@@ -192,6 +192,7 @@ class SlurmSnapManager(SlurmOpsManagerBase):
         else:
             self._install_slurm_snap_from_edge()
 
+        self._prepare_template_cache()
         self._provision_snap_systemd_service_override_file()
         self._systemctld_daemon_reload()
         self._set_snap_mode()
@@ -1,23 +1,110 @@
 #!/usr/bin/env python3
 """This module provides the SlurmInstallManager."""
+import grp
 import logging
 import os
+import pwd
+import shutil
+import stat
 import subprocess
 import sys
+import tarfile
 from pathlib import Path
-from time import sleep
 
-from slurm_ops_manager.slurm_ops_base import SlurmOpsManagerBase
+from slurm_ops_manager.slurm_ops_base import (
+    SlurmOpsManagerBase,
+    TEMPLATE_DIR,
+)
 
 
 logger = logging.getLogger()
 
+_SYSCONFIG_DIR = Path("/etc/sysconfig")
+
+# The per component file locations only depend on the component name.
+_COMPONENT_PATHS = {
+    component: {
+        'service_src': TEMPLATE_DIR / f'{component}.service',
+        'service_dst': Path(f'/etc/systemd/system/{component}.service'),
+        'environment_file': _SYSCONFIG_DIR / component,
+    }
+    for component in ('slurmd', 'slurmctld', 'slurmdbd', 'slurmrestd')
+}
+
+_APT_INSTALL_OS_DEPS = [
+    'apt',
+    'install',
+    'libmunge2',
+    'libmysqlclient-dev',
+    'munge',
+    '-y',
+]
+_YUM_INSTALL_OS_DEPS = [
+    'yum',
+    'install',
+    '-y',
+    'mariadb-devel',
+    'munge',
+]
+_OS_DEPS_INSTALL_CMDS = {
+    'ubuntu': _APT_INSTALL_OS_DEPS,
+    'debian': _APT_INSTALL_OS_DEPS,
+    'centos': _YUM_INSTALL_OS_DEPS,
+    'rhel': _YUM_INSTALL_OS_DEPS,
+}
+
+
+# Mode bits that must never end up on the installed slurm files.
+_UNSAFE_MODE_BITS = (
+    stat.S_ISUID | stat.S_ISGID | stat.S_ISVTX | stat.S_IWGRP | stat.S_IWOTH
+)
+
+
+def _link_or_copy(src, dst) -> None:
+    """Hardlink src to dst, falling back to a root owned copy.
+
+    A hardlink shares ownership and mode with src, so only files that are
+    already root owned and free of unsafe mode bits are linked.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+
+    src_stat = os.lstat(src)
+    if src_stat.st_uid == 0 and src_stat.st_gid == 0 and \
+            not src_stat.st_mode & _UNSAFE_MODE_BITS:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+    os.chown(dst, 0, 0)
+    os.chmod(dst, stat.S_IMODE(src_stat.st_mode) & ~_UNSAFE_MODE_BITS)
+
+
+def _install_tree(src, dst) -> None:
+    """Merge the contents of src into dst, like `cp -R src/* dst/`."""
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+
+        for name in dirs + files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(source):
+                if os.path.lexists(target):
+                    os.unlink(target)
+                os.symlink(os.readlink(source), target)
+            elif name in files:
+                _link_or_copy(source, target)
+
 
 class SlurmTarManager(SlurmOpsManagerBase):
     """Operations for slurm tar resource."""
 
     _SLURM_SBIN_DIR = Path('/usr/local/sbin')
-    _SLURM_SYSCONFIG_DIR = Path("/etc/sysconfig")
+    _SLURM_SYSCONFIG_DIR = _SYSCONFIG_DIR
 
     _SLURM_UID = 990
     _SLURM_GID = 990
@@ -27,12 +114,10 @@ class SlurmTarManager(SlurmOpsManagerBase):
     def __init__(self, component, resource_path):
         """Set initial class attribute values."""
         super().__init__(component, resource_path)
-        self._source_systemd_template = \
-            self._template_dir / f'{self._slurm_component}.service'
-        self._target_systemd_template = \
-            Path(f'/etc/systemd/system/{self._slurm_component}.service')
-        self._environment_file = \
-            self._SLURM_SYSCONFIG_DIR / f'{self._slurm_component}'
+        component_paths = _COMPONENT_PATHS[self._slurm_component]
+        self._source_systemd_template = component_paths['service_src']
+        self._target_systemd_template = component_paths['service_dst']
+        self._environment_file = component_paths['environment_file']
 
     @property
     def _slurm_conf_dir(self) -> Path:
@@ -111,6 +196,7 @@ class SlurmTarManager(SlurmOpsManagerBase):
 
     def upgrade(self):
         """Run upgrade operations."""
+        self._prepare_template_cache()
         self._provision_slurm_resource()
 
     def setup_system(self) -> None:
@@ -123,6 +209,7 @@ class SlurmTarManager(SlurmOpsManagerBase):
         self._install_os_deps()
         self._create_slurm_user_and_group()
         self._prepare_filesystem()
+        self._prepare_template_cache()
         self._create_environment_files()
 
         self._provision_slurm_resource()
@@ -131,29 +218,16 @@ class SlurmTarManager(SlurmOpsManagerBase):
         self._setup_systemd()
 
     def _install_os_deps(self) -> None:
-        if self.os == 'ubuntu':
-            try:
-                subprocess.call([
-                    'apt',
-                    'install',
-                    'libmunge2',
-                    'libmysqlclient-dev',
-                    'munge',
-                    '-y',
-                ])
-            except subprocess.CalledProcessError as e:
-                logger.debug(e)
-        else:
-            try:
-                subprocess.call([
-                    'yum',
-                    'install',
-                    '-y',
-                    'mariadb-devel',
-                    'munge',
-                ])
-            except subprocess.CalledProcessError as e:
-                logger.debug(e)
+        install_cmd = _OS_DEPS_INSTALL_CMDS.get(self.os)
+        if install_cmd is None:
+            msg = f"Unsupported operating system: {self.os}"
+            logger.error(msg)
+            raise Exception(msg)
+
+        try:
+            subprocess.run(install_cmd, check=True)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error installing os dependencies - {e}")
 
         if not self._munge_key_path.exists():
             self._munge_key_path.write_bytes(os.urandom(1024))
@@ -162,24 +236,24 @@ class SlurmTarManager(SlurmOpsManagerBase):
     def _create_slurm_user_and_group(self) -> None:
         """Create the slurm user and group."""
         try:
-            subprocess.call([
+            subprocess.run([
                 "groupadd",
                 "-r",
                 f"--gid={self._SLURM_GID}",
                 self._slurm_user,
-            ])
+            ], check=True)
         except subprocess.CalledProcessError as e:
             logger.error(f"Error creating {self._slurm_group} - {e}")
 
         try:
-            subprocess.call([
+            subprocess.run([
                 "useradd",
                 "-r",
                 "-g",
                 self._slurm_group,
                 f"--uid={self._SLURM_UID}",
                 self._slurm_user,
-            ])
+            ], check=True)
         except subprocess.CalledProcessError as e:
             logger.error(f"Error creating {self._slurm_user} - {e}")
 
@@ -196,7 +270,6 @@ class SlurmTarManager(SlurmOpsManagerBase):
         ]
         for slurm_dir in slurm_dirs:
             slurm_dir.mkdir(parents=True, exist_ok=True)
-            self._chown_slurm_user_and_group_recursive(str(slurm_dir))
 
         slurm_state_files = [
             "/var/lib/slurmd/node_state",
@@ -211,19 +284,34 @@ class SlurmTarManager(SlurmOpsManagerBase):
         ]
         for slurmd_file in slurm_state_files:
             Path(slurmd_file).touch()
-        self._chown_slurm_user_and_group_recursive('/var/lib/slurmd')
 
-    def _chown_slurm_user_and_group_recursive(self, slurm_dir) -> None:
-        """Recursively chown filesystem location to slurm user/slurm group."""
+        # The state files live in the state dir, so a single chown over all
+        # of the slurm dirs covers them too.
+        self._chown_slurm_user_and_group_recursive(
+            *[str(slurm_dir) for slurm_dir in slurm_dirs]
+        )
+
+    def _chown_slurm_user_and_group_recursive(self, *slurm_dirs) -> None:
+        """Recursively chown filesystem locations to slurm user/slurm group."""
         try:
-            subprocess.call([
-                "chown",
-                "-R",
-                f"{self._slurm_user}:{self._slurm_group}",
-                slurm_dir,
-            ])
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error chowning {slurm_dir} - {e}")
+            uid = pwd.getpwnam(self._slurm_user).pw_uid
+            gid = grp.getgrnam(self._slurm_group).gr_gid
+        except KeyError as e:
+            logger.error(f"Error resolving slurm user/group - {e}")
+            return
+
+        def _chown(path, follow_symlinks=False) -> None:
+            # Like chown -R, log a failure and carry on with the rest.
+            try:
+                os.chown(path, uid, gid, follow_symlinks=follow_symlinks)
+            except OSError as e:
+                logger.error(f"Error chowning {path} - {e}")
+
+        for slurm_dir in slurm_dirs:
+            _chown(slurm_dir, follow_symlinks=True)
+            for root, dirs, files in os.walk(slurm_dir):
+                for name in dirs + files:
+                    _chown(os.path.join(root, name))
 
     def _create_environment_files(self) -> None:
         slurm_conf = f"\nSLURM_CONF={str(self._slurm_conf_path)}\n"
@@ -233,56 +321,97 @@ class SlurmTarManager(SlurmOpsManagerBase):
 
     def _provision_slurm_resource(self) -> None:
         """Provision the slurm resource."""
-        if not self._SLURM_TMP_RESOURCE.exists():
-            self._SLURM_TMP_RESOURCE.mkdir(parents=True)
-
-        try:
-            subprocess.call([
-                "tar",
-                "-xzvf",
-                self._resource_path,
-                "-C",
-                str(self._SLURM_TMP_RESOURCE),
-            ])
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error untaring slurm bins - {e}")
-
-        # Wait on the existence of slurmd bin to verify that the untaring
-        # of the slurm.tar.gz resource has completed before moving on.
-        while not Path(
-           f"{str(self._SLURM_TMP_RESOURCE)}/sbin/slurmd").exists():
-            sleep(1)
-
+        # Hook re-runs usually see the same resource; skip the work if this
+        # exact file has already been extracted and installed.
+        resource_mtime = os.stat(self._resource_path).st_mtime_ns
+        sentinel = self._SLURM_TMP_RESOURCE / f'.extracted-{resource_mtime}'
+        if sentinel.exists():
+            logger.debug('_provision_slurm_resource(): already provisioned.')
+            return
+
+        # Raises if the resource cannot be fully extracted, so the sentinel
+        # below is only written once extraction and install both succeeded.
+        self._extract_slurm_resource()
+
+        provisioned = True
         for slurm_resource_dir in ['bin', 'sbin', 'lib', 'include']:
-            cmd = (
-                f"cp -R {str(self._SLURM_TMP_RESOURCE)}/"
-                f"{slurm_resource_dir}/* /usr/local/{slurm_resource_dir}/"
-            )
             try:
-                subprocess.call(cmd, shell=True)
-            except subprocess.CalledProcessError as e:
+                _install_tree(
+                    str(self._SLURM_TMP_RESOURCE / slurm_resource_dir),
+                    f"/usr/local/{slurm_resource_dir}",
+                )
+            except OSError as e:
                 logger.error(f"Error provisioning fs - {e}")
+                provisioned = False
+
+        if provisioned:
+            sentinel.touch()
+
+    def _extract_slurm_resource(self) -> None:
+        """Extract the slurm resource into the temporary resource dir."""
+        # Always extract into a fresh tree; the installed files are hardlinks
+        # into it and must not be rewritten in place.
+        if self._SLURM_TMP_RESOURCE.exists():
+            shutil.rmtree(str(self._SLURM_TMP_RESOURCE))
+        self._SLURM_TMP_RESOURCE.mkdir(parents=True)
+
+        try:
+            with tarfile.open(self._resource_path, 'r:gz') as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(
+                        str(self._SLURM_TMP_RESOURCE), filter='data'
+                    )
+                else:
+                    # Without the data filter tarfile restores the archive's
+                    # owners and modes; the installed files may be hardlinks
+                    # to these, so make them root owned with safe modes.
+                    members = tar.getmembers()
+                    for member in members:
+                        member.uid = member.gid = 0
+                        member.uname = member.gname = 'root'
+                        member.mode &= ~_UNSAFE_MODE_BITS
+                    tar.extractall(
+                        str(self._SLURM_TMP_RESOURCE), members=members
+                    )
+        except (tarfile.TarError, OSError) as e:
+            # A partial tree must never be installed, so fail the hook.
+            msg = f"Error untaring slurm bins - {e}"
+            logger.error(msg)
+            raise Exception(msg) from e
+
+        # Extraction is synchronous, so the slurmd bin is either there or
+        # the resource is broken.
+        if not (self._SLURM_TMP_RESOURCE / 'sbin' / 'slurmd').exists():
+            msg = "slurmd not found in the slurm resource."
+            logger.error(msg)
+            raise Exception(msg)
 
     def _set_ld_library_path(self) -> None:
         """Set the LD_LIBRARY_PATH."""
         Path('/etc/ld.so.conf.d/slurm.conf').write_text("/usr/local/lib/slurm")
         try:
-            subprocess.call(["ldconfig"])
+            subprocess.run(["ldconfig"], check=True)
         except subprocess.CalledProcessError as e:
             logger.error(f"Error setting LD_LIBRARY_PATH - {e}")
 
     def _setup_systemd(self) -> None:
         """Preforms setup the systemd service."""
         try:
-            subprocess.call([
-                "cp",
-                self._source_systemd_template,
-                self._target_systemd_template
-            ])
-            subprocess.call([
+            shutil.copyfile(
+                str(self._source_systemd_template),
+                str(self._target_systemd_template),
+            )
+            subprocess.run([
                 "systemctl",
                 "daemon-reload",
-            ])
-            self._slurm_systemctl("enable")
-        except subprocess.CalledProcessError as e:
+            ], check=True)
+            # The units are conditioned on the slurm config existing, so
+            # starting them before the config is rendered is a no-op.
+            subprocess.run([
+                "systemctl",
+                "enable",
+                "--now",
+                self._slurm_systemd_service,
+            ], check=True)
+        except (subprocess.CalledProcessError, OSError) as e:
             logger.error(f"Error setting up systemd - {e}")